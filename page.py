@@ -1,14 +1,23 @@
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, Response
 from flask_sock import Sock
-import json
+import orjson
+import queue
 import threading
-import time
 import logging
+from dataclasses import dataclass, field
 from werkzeug.serving import WSGIRequestHandler
 
 app = Flask(__name__)
+# simple_websocket sends protocol-level pings and closes clients that stop
+# answering, which ends their handler and runs its cleanup
+app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 25}
 sock = Sock(app)
 
+
+def dumps(obj):
+    # orjson returns bytes; decode so messages still go out as text frames
+    return orjson.dumps(obj).decode()
+
 # reduce default access logging (don't show raw IPs)
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 app.logger.setLevel(logging.INFO)
@@ -30,11 +39,34 @@ class QuietHandler(WSGIRequestHandler):
         except Exception:
             pass
 
+@dataclass(slots=True)
+class Client:
+    # everything we track for one connected player
+    id: int
+    ws: object
+    out_q: 'OutboundQueue'  # messages waiting for this client's writer thread
+    x: float = 100          # Default position for new players
+    y: float = 100
+    sprite: str = 'new player'  # sprite data (image or letter)
+    name: str = ''          # chat name
+    slow: bool = False      # fell behind on outbound messages, being disconnected
+    # outgoing messages reused for every event from this client; only its own
+    # websocket thread touches them and they're serialized right after filling
+    _move_tmpl: dict = field(init=False, repr=False)
+    _sprite_tmpl: dict = field(init=False, repr=False)
+    _name_tmpl: dict = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._move_tmpl = {'type': 'move', 'id': self.id, 'x': 0, 'y': 0}
+        self._sprite_tmpl = {'type': 'update_sprite', 'id': self.id, 'sprite': ''}
+        self._name_tmpl = {'type': 'update_name', 'id': self.id, 'name': ''}
+
 # store connected clients and their data
-clients = {}
-positions = {}  # store positions of all players
-sprites = {}    # store sprite data (image or letter) for all players
-names = {}      # store chat names for all players
+clients = {}    # client id -> Client
+# guards clients and the per-client fields mutated from websocket threads
+state_lock = threading.RLock()
+# serialized /users body; reset to None whenever a name is added/removed/changed
+_users_cache = None
 # simple thread-safe counter for short display names (Player1, Player2...)
 name_counter = 1
 name_lock = threading.Lock()
@@ -46,45 +78,228 @@ def assign_display_name():
         name_counter += 1
     return name
 
-def cleanup_disconnected_clients():
+def peers():
+    # snapshot of connected clients, taken under the lock so broadcasts can
+    # iterate without holding it while other threads connect/disconnect
+    with state_lock:
+        return tuple(clients.values())
+
+def user_names():
+    with state_lock:
+        return [c.name for c in clients.values()]
+
+# max messages buffered per client before new ones are dropped
+OUTBOUND_QUEUE_SIZE = 256
+
+class OutboundQueue(queue.Queue):
+    # queue that keeps at most one pending move per sender; a newer move
+    # overwrites the queued one in place since only the latest position matters
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.move_slots = {}  # sender id -> [payload] still waiting in the queue
+
+    def _get(self):
+        item = super()._get()
+        if isinstance(item, tuple):
+            sender_id, slot = item
+            del self.move_slots[sender_id]
+            return slot[0]
+        return item
+
+    def put_move(self, sender_id, payload):
+        with self.not_full:
+            slot = self.move_slots.get(sender_id)
+            if slot is not None:
+                slot[0] = payload
+                return
+            if 0 < self.maxsize <= self._qsize():
+                raise queue.Full
+            slot = [payload]
+            self.move_slots[sender_id] = slot
+            self._put((sender_id, slot))
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+# writer sentinel: stop and close the websocket (None just stops the writer)
+DISCONNECT = object()
+
+def enqueue(client, payload, move_from=None):
+    # hand a message to a client's writer thread without blocking the sender
+    if client.slow:
+        return
+    try:
+        if move_from is None:
+            client.out_q.put_nowait(payload)
+        else:
+            client.out_q.put_move(move_from, payload)
+    except queue.Full:
+        # dropping chat/name/sprite/roster messages would leave this peer out
+        # of sync for good, so disconnect it rather than stall everyone else;
+        # its handler's finally deregisters it and a reconnect gets a fresh roster
+        client.slow = True
+        app.logger.warning("%s is not keeping up, disconnecting", client.name)
+        stop_writer(client.out_q, DISCONNECT)
+
+def writer_loop(ws, q):
+    # single writer per client so a slow socket only delays its own messages
     while True:
-        time.sleep(10)  # clean up every 10 seconds
-        # iterate over a snapshot to allow removing while iterating
-        for client_id, ws in list(clients.items()):
+        # block for the first message, then drain whatever else is already
+        # waiting so it all goes out as one frame
+        batch = [q.get()]
+        while batch[-1] not in (None, DISCONNECT):
             try:
-                # ping; if this raises, client is likely disconnected/malformed
-                ws.send(json.dumps({"type": "ping"}))
-            except Exception:
-                # remove immediately (best-effort) and avoid exposing network info
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+        stop = batch[-1] in (None, DISCONNECT)
+        if stop:
+            sentinel = batch.pop()
+        try:
+            if len(batch) == 1:
+                ws.send(batch[0])
+            elif batch:
+                # client unpacks a top-level array into individual messages
+                ws.send('[' + ','.join(batch) + ']')
+        except Exception:
+            return
+        if stop:
+            if sentinel is DISCONNECT:
                 try:
-                    if client_id in clients:
-                        del clients[client_id]
-                    if client_id in positions:
-                        del positions[client_id]
-                    if client_id in sprites:
-                        del sprites[client_id]
-                    if client_id in names:
-                        removed_name = names.pop(client_id, None)
-                    else:
-                        removed_name = None
+                    ws.close()
                 except Exception:
-                    removed_name = None
+                    pass
+            return
+
+def stop_writer(q, sentinel=None):
+    # wake the writer with a sentinel, making room if the queue is full
+    while True:
+        try:
+            q.put_nowait(sentinel)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+# limits on client-supplied fields; anything outside them is rejected before
+# it touches state or gets rebroadcast to every peer
+MAX_COORD = 10000       # page.html clamps movement to the same bound
+MAX_SPRITE_LEN = 2048   # sprites can be image/video/audio URLs
+MAX_NAME_LEN = 32
+MAX_MESSAGE_LEN = 1000
+MAX_COLOR_LEN = 32
+
+def valid_coord(v):
+    # bool is an int subclass, so rule it out explicitly
+    return (isinstance(v, (int, float)) and not isinstance(v, bool)
+            and -MAX_COORD <= v <= MAX_COORD)
 
-                # friendly log only (no IPs)
-                app.logger.info(f"Removed disconnected client: {removed_name or client_id}")
+def valid_text(v, max_len):
+    return isinstance(v, str) and len(v) <= max_len
 
-                # notify remaining clients of updated user list (names only)
-                for other_id, other_ws in list(clients.items()):
-                    try:
-                        other_ws.send(json.dumps({
-                            'type': 'user_names',
-                            'users': list(names.values())
-                        }))
-                    except:
-                        pass
+def reject(client, field):
+    # tell the sender what was refused instead of silently dropping it
+    app.logger.warning("Rejected %s from %s", field, client.name)
+    enqueue(client, dumps({
+        'type': 'error',
+        'message': 'invalid_field',
+        'field': field
+    }))
 
-# start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_disconnected_clients, daemon=True)
+def clean_style(style):
+    # rebuild the chat style from the keys page.html sends; anything else
+    # (or a style that isn't an object at all) is dropped, not forwarded
+    if not isinstance(style, dict):
+        return {}
+    clean = {}
+    if valid_text(style.get('color'), MAX_COLOR_LEN):
+        clean['color'] = style['color']
+    for key in ('bold', 'italic'):
+        if isinstance(style.get(key), bool):
+            clean[key] = style[key]
+    return clean
+
+def handle_move(client, data):
+    x = data.get('x')
+    y = data.get('y')
+    if not (valid_coord(x) and valid_coord(y)):
+        reject(client, 'position')
+        return
+    # nothing to tell anyone if the player didn't actually move
+    if client.x == x and client.y == y:
+        return
+    # updates positions in local client
+    with state_lock:
+        client.x = x
+        client.y = y
+    # tells other clients position
+    t = client._move_tmpl
+    t['x'] = x
+    t['y'] = y
+    payload = dumps(t)
+    for other in peers():
+        if other is not client:
+            enqueue(other, payload, move_from=client.id)
+
+def handle_chat(client, data):
+    if not valid_text(data.get('message'), MAX_MESSAGE_LEN):
+        reject(client, 'message')
+        return
+    # send message in chat with styles
+    payload = dumps({
+        'type': 'chat',
+        'id': client.id,
+        'name': client.name,
+        'message': data['message'],
+        'style': clean_style(data.get('style'))  # Include style if provided
+    })
+    for other in peers():
+        enqueue(other, payload)
+    app.logger.info("%s: %s", client.name, data['message'])
+
+def handle_update_sprite(client, data):
+    if not valid_text(data.get('sprite'), MAX_SPRITE_LEN):
+        reject(client, 'sprite')
+        return
+    # new sprite for new client
+    with state_lock:
+        client.sprite = data['sprite']
+    # lets clients know
+    t = client._sprite_tmpl
+    t['sprite'] = data['sprite']
+    payload = dumps(t)
+    for other in peers():
+        if other is not client:
+            enqueue(other, payload)
+    app.logger.info("%s updated sprite to: %s", client.name, data['sprite'])
+
+def handle_update_name(client, data):
+    global _users_cache
+    if not valid_text(data.get('name'), MAX_NAME_LEN):
+        reject(client, 'name')
+        return
+    # name for new client
+    with state_lock:
+        old_name = client.name
+        client.name = data['name']
+        _users_cache = None
+    # lets clients know
+    t = client._name_tmpl
+    t['name'] = data['name']
+    payload = dumps(t)
+    for other in peers():
+        if other is not client:
+            enqueue(other, payload)
+    app.logger.info("%s changed name to %s", old_name, data['name'])
+
+# message type -> handler(client, data)
+HANDLERS = {
+    'move': handle_move,
+    'chat': handle_chat,
+    'update_sprite': handle_update_sprite,
+    'update_name': handle_update_name,
+}
 
 @app.route('/')
 def home():
@@ -92,45 +307,51 @@ def home():
 
 @sock.route('/ws')
 def websocket(ws):
+    global _users_cache
     # make id for clients
     client_id = id(ws)
-    clients[client_id] = ws
-    positions[client_id] = {'x': 100, 'y': 100}  # Default position for new players
-    sprites[client_id] = 'new player'  # default sprite
-    names[client_id] = assign_display_name()  # default shortname
+    client = Client(client_id, ws, OutboundQueue(maxsize=OUTBOUND_QUEUE_SIZE))
+    client.name = assign_display_name()  # default shortname
+    with state_lock:
+        # snapshot everyone already here before registering ourselves
+        others = tuple(clients.values())
+        known = [(o.id, o.x, o.y, o.sprite, o.name) for o in others]
+        clients[client_id] = client
+        _users_cache = None
     # use chat name instead of ip address for logging
-    app.logger.info(f"Connected: {names[client_id]}")
+    app.logger.info("Connected: %s", client.name)
 
     # lets previous clients know about new client
-    for other_id, other_ws in clients.items():
-        if other_id != client_id:
-            try:
-                other_ws.send(json.dumps({
-                    'type': 'new_player',
-                    'id': client_id,
-                    'x': positions[client_id]['x'],
-                    'y': positions[client_id]['y'],
-                    'sprite': sprites[client_id],
-                    'name': names[client_id]
-                }))
-            except:
-                pass
+    payload = dumps({
+        'type': 'new_player',
+        'id': client_id,
+        'x': client.x,
+        'y': client.y,
+        'sprite': client.sprite,
+        'name': client.name
+    })
+    for other in others:
+        enqueue(other, payload)
 
-    # lets new clients know about previous clients
+    # lets new clients know about previous clients, all in one array frame
+    # so the whole roster goes out in a single write
     try:
-        for other_id, position in positions.items():
-            if other_id != client_id:
-                ws.send(json.dumps({
-                    'type': 'new_player',
-                    'id': other_id,
-                    'x': position['x'],
-                    'y': position['y'],
-                    'sprite': sprites[other_id],
-                    'name': names[other_id]
-                }))
+        if known:
+            ws.send('[' + ','.join(dumps({
+                'type': 'new_player',
+                'id': other_id,
+                'x': x,
+                'y': y,
+                'sprite': sprite,
+                'name': other_name
+            }) for other_id, x, y, sprite, other_name in known) + ']')
     except:
         pass
 
+    # from here on everything sent to this client goes through its queue
+    writer = threading.Thread(target=writer_loop, args=(ws, client.out_q), daemon=True)
+    writer.start()
+
     try:
         while True:
             raw = ws.receive()
@@ -138,116 +359,61 @@ def websocket(ws):
             if raw is None:
                 break
             try:
-                data = json.loads(raw)
-            except json.JSONDecodeError:
-                app.logger.warning(f"Bad JSON from {names.get(client_id, client_id)}: {raw!r}")
+                data = orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                app.logger.warning("Bad JSON from %s: %r", client.name, raw)
                 # reply with structured error if possible
-                try:
-                    ws.send(json.dumps({
-                        'type': 'error',
-                        'message': 'invalid_json',
-                        'raw': str(raw)[:200]
-                    }))
-                except:
-                    pass
+                enqueue(client, dumps({
+                    'type': 'error',
+                    'message': 'invalid_json',
+                    'raw': str(raw)[:200]
+                }))
                 continue
             except Exception as e:
-                app.logger.exception(f"Error parsing payload from {names.get(client_id, client_id)}")
-                try:
-                    ws.send(json.dumps({
-                        'type': 'error',
-                        'message': 'parse_error'
-                    }))
-                except:
-                    pass
+                app.logger.exception("Error parsing payload from %s", client.name)
+                enqueue(client, dumps({
+                    'type': 'error',
+                    'message': 'parse_error'
+                }))
+                continue
+            # every message must be an object with a string type
+            msg_type = data.get('type') if isinstance(data, dict) else None
+            if not isinstance(msg_type, str):
+                app.logger.warning("Malformed message from %s: %.200r", client.name, raw)
+                enqueue(client, dumps({
+                    'type': 'error',
+                    'message': 'invalid_message'
+                }))
                 continue
-            if data['type'] == 'move':
-                # updates positions in local client
-                positions[client_id] = {'x': data['x'], 'y': data['y']}
-                # tells other clients position
-                for other_id, other_ws in clients.items():
-                    if other_id != client_id:
-                        try:
-                            other_ws.send(json.dumps({
-                                'type': 'move',
-                                'id': client_id,
-                                'x': data['x'],
-                                'y': data['y']
-                            }))
-                        except:
-                            pass
-            elif data['type'] == 'chat':
-                # send message in chat with styles
-                for other_id, other_ws in clients.items():
-                    try:
-                        other_ws.send(json.dumps({
-                            'type': 'chat',
-                            'id': client_id,
-                            'name': names[client_id],
-                            'message': data['message'],
-                            'style': data.get('style', {})  # Include style if provided
-                        }))
-                    except:
-                        pass
-                app.logger.info(f"{names.get(client_id, client_id)}: {data['message']}")
-            elif data['type'] == 'update_sprite':
-                # new sprite for new client
-                sprites[client_id] = data['sprite']
-                # lets clients know
-                for other_id, other_ws in clients.items():
-                    if other_id != client_id:
-                        try:
-                            other_ws.send(json.dumps({
-                                'type': 'update_sprite',
-                                'id': client_id,
-                                'sprite': data['sprite']
-                            }))
-                        except:
-                            pass
-                app.logger.info(f"{names.get(client_id, client_id)} updated sprite to: {data['sprite']}")
-            elif data['type'] == 'update_name':
-                # name for new client
-                old_name = names.get(client_id, f'Player {client_id}')
-                names[client_id] = data['name']
-                # lets clients know
-                for other_id, other_ws in clients.items():
-                    if other_id != client_id:
-                        try:
-                            other_ws.send(json.dumps({
-                                'type': 'update_name',
-                                'id': client_id,
-                                'name': data['name']
-                            }))
-                        except:
-                            pass
-                app.logger.info(f"{old_name} changed name to {data['name']}")
+            handle = HANDLERS.get(msg_type)
+            if handle:
+                handle(client, data)
     except:
         pass
     finally:
         # remove client thumbup
-        if client_id in clients:
-            del clients[client_id]
-        if client_id in positions:
-            del positions[client_id]
-        if client_id in sprites:
-            del sprites[client_id]
-        if client_id in names:
-            del names[client_id]
+        with state_lock:
+            clients.pop(client_id, None)
+            _users_cache = None
+        stop_writer(client.out_q)
         # notify remaining clients of updated user list (names only)
-        for other_id, other_ws in clients.items():
-            try:
-                other_ws.send(json.dumps({
-                    'type': 'user_names',
-                    'users': list(names.values())
-                }))
-            except:
-                pass
+        payload = dumps({
+            'type': 'user_names',
+            'users': user_names()
+        })
+        for other in peers():
+            enqueue(other, payload)
 
 
 @app.route('/users')
 def users():
     # return only display names — do NOT expose IP addresses or raw connection ids
-    return jsonify(list(names.values()))
+    global _users_cache
+    with state_lock:
+        if _users_cache is None:
+            _users_cache = orjson.dumps([c.name for c in clients.values()])
+        body = _users_cache
+    return Response(body, mimetype='application/json')
 
 
 @app.route('/players')
@@ -256,12 +422,8 @@ def players_page():
     return render_template('players.html')
 
 if __name__ == '__main__':
-    # start background maintenance thread from the running process
-    try:
-        cleanup_thread.start()
-    except RuntimeError:
-        # thread already started
-        pass
-    # run without the reloader so background threads stay in the same process
+    # local dev server only; in production run under gunicorn instead:
+    #   gunicorn -k gevent -w 1 -b 0.0.0.0:11291 page:app
+    # (one worker, since connected players live in this process's memory)
     # use a custom request handler to suppress low-level "Bad request version" logs
-    app.run(host='0.0.0.0', port=11291, debug=True, use_reloader=False, request_handler=QuietHandler)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=11291, request_handler=QuietHandler)
\ No newline at end of file